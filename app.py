@@ -1,25 +1,33 @@
-from urllib.parse import urlparse
+import functools
+import re
 from datetime import datetime
 import streamlit as st
 import timetable_parser
 
 
-@st.cache_data
+@st.cache_data(ttl=timetable_parser.HTTP_CACHE_EXPIRE)
+def fetch_timetable(url):
+    """Fetch and parse the timetable, shared by the class list and the calendar."""
+    return timetable_parser.parse_all(url)
+
+
 def fetch_class_options(url):
     """Fetch available classes from the timetable URL."""
-    classes = timetable_parser.get_available_classes(url)
+    class_options, _ = fetch_timetable(url)
     # Sort classes alphabetically by module name
-    classes.sort(key=lambda x: x.split(" - ")[1])
-    return classes
+    return sorted(class_options, key=lambda x: x.split(" - ")[1])
+
 
+_URL_RE = re.compile(
+    r'^(?i:https?)://timetablingunmc\.nottingham\.ac\.uk(?::\d+)?/reporting/TextSpreadsheet')
 
+
+@functools.lru_cache(maxsize=32)
 def validate_url(url):
     """Validate the URL is a valid UNMC timetable URL in list view.
     We don't check the port number, as it seems it's different for different years
     (i.e 23/24 is 8006, 24/25 is 8016) """
-    parsed_url = urlparse(url)
-    return (parsed_url.netloc.split(":")[0] == "timetablingunmc.nottingham.ac.uk"
-            and parsed_url.path.startswith("/reporting/TextSpreadsheet"))
+    return _URL_RE.match(url) is not None
 
 
 def render_page():
@@ -41,25 +49,28 @@ def render_page():
     timetable_url = st.text_input(
         "Timetable URL",
         placeholder="i.e http://timetablingunmc.nottingham.ac.uk:8016/reporting/TextSpreadsheet;programme+of+study;id;..."
-    )
+    ).strip()
 
     academic_year_start = st.date_input(
         "Week 1 start date (Undergraduates start studying at week 4)", datetime(2024, 9, 2))
 
     if timetable_url and validate_url(timetable_url):
         class_options = fetch_class_options(timetable_url)
-        # Allow user to select classes using pills
-        selected_classes = st.pills(
-            "Classes to include", class_options, selection_mode="multi", default=class_options)
+        # Allow user to select classes using a multiselect
+        selected_classes = st.multiselect(
+            "Classes to include", class_options, default=class_options)
 
         if st.button("Generate Calendar"):
-            # Define a filter function
-            def class_filter(module_code, module_name, _event_type):
-                return f"{module_code} - {module_name}" in selected_classes
+            # Define a filter function, bound to a set for O(1) lookups
+            selected_set = frozenset(selected_classes)
+
+            def class_filter(module_code, module_name, _event_type, _selected=selected_set):
+                return f"{module_code} - {module_name}" in _selected
 
             # Generate the calendar
-            calendar_data = timetable_parser.create_ics(
-                timetable_url, academic_year_start, class_filter=class_filter)
+            _, class_rows = fetch_timetable(timetable_url)
+            calendar_data = timetable_parser.build_ics(
+                class_rows, academic_year_start, class_filter=class_filter)
 
             # Create a download button
             st.download_button(
@@ -1,163 +1,298 @@
 import os
-from datetime import datetime, timedelta
+import re
+import time
+import functools
+from collections import namedtuple
+from datetime import date, datetime
 import requests
-from bs4 import BeautifulSoup
-from icalendar import Calendar, Event
-import pytz
+import requests_cache
+from requests.adapters import HTTPAdapter
+from bs4 import BeautifulSoup, SoupStrainer
 
 # Timeout in seconds, default to 10 if not set
 REQUEST_TIMEOUT = int(os.getenv('REQUEST_TIMEOUT', '10'))
 
-
+# On-disk HTTP cache lifetime in seconds, default to 3600, 0 disables the cache.
+# The app caches parsed timetables for the same time on top of this, so a
+# calendar it serves can be built from a page up to 2 * HTTP_CACHE_EXPIRE old
+HTTP_CACHE_EXPIRE = int(os.getenv('HTTP_CACHE_EXPIRE', '3600'))
+
+# Shared session so consecutive fetches reuse pooled connections
+if HTTP_CACHE_EXPIRE > 0:
+    _SESSION = requests_cache.CachedSession(
+        'unmc_tt_cache', backend='sqlite', expire_after=HTTP_CACHE_EXPIRE)
+else:
+    _SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(pool_connections=4, pool_maxsize=4)
+_SESSION.mount('http://', _ADAPTER)
+_SESSION.mount('https://', _ADAPTER)
+# Timetable pages are large and compress well, make sure they arrive compressed
+_SESSION.headers.update({'Accept-Encoding': 'gzip, deflate'})
+
+
+TZID = 'Asia/Kuala_Lumpur'
+
+DAY_SECONDS = 24 * 60 * 60
+WEEK_SECONDS = 7 * DAY_SECONDS
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+# Matches the text of a day header paragraph, e.g. "Monday"
+_DAY_RE = re.compile(r'^\s*(Monday|Tuesday|Wednesday|Thursday|Friday)\s*$')
+
+# Map day names to numbers (0 = Monday)
+DAY_MAP = {'Monday': 0, 'Tuesday': 1,
+           'Wednesday': 2, 'Thursday': 3, 'Friday': 4}
+
+# Map day offsets to iCalendar day abbreviations
+DAY_ABBR = ['MO', 'TU', 'WE', 'TH', 'FR']
+
+# Malaysia has a fixed UTC+8 offset, so a single STANDARD block suffices
+VTIMEZONE = (
+    "BEGIN:VTIMEZONE\r\n"
+    f"TZID:{TZID}\r\n"
+    "BEGIN:STANDARD\r\n"
+    "DTSTART:19700101T000000\r\n"
+    "TZOFFSETFROM:+0800\r\n"
+    "TZOFFSETTO:+0800\r\n"
+    "TZNAME:+08\r\n"
+    "END:STANDARD\r\n"
+    "END:VTIMEZONE\r\n"
+)
+
+# A single class session as listed in the timetable. Times and weeks are kept
+# as the raw cell text and only parsed for the classes that end up in a calendar
+ClassRow = namedtuple('ClassRow', [
+    'module_code', 'module_name', 'event_type', 'size', 'day_offset',
+    'start_time', 'end_time', 'location', 'staff', 'weeks_text'])
+
+
+def escape_text(value):
+    """escape a TEXT property value (RFC 5545, section 3.3.11)"""
+    return (value.replace('\\', '\\\\').replace(';', '\\;')
+            .replace(',', '\\,').replace('\r\n', '\\n').replace('\r', '\\n')
+            .replace('\n', '\\n'))
+
+
+def fold_line(line):
+    """fold a content line longer than 75 octets (RFC 5545, section 3.1)"""
+    if len(line.encode('utf-8')) <= 75:
+        return line
+
+    # Continuation lines start with a space, which counts towards the limit
+    chunks, chunk, size, limit = [], [], 0, 75
+    for char in line:
+        char_size = len(char.encode('utf-8'))
+        if size + char_size > limit:
+            chunks.append(''.join(chunk))
+            chunk, size, limit = [], 0, 74
+        chunk.append(char)
+        size += char_size
+    chunks.append(''.join(chunk))
+    return '\r\n '.join(chunks)
+
+
+@functools.lru_cache(maxsize=128)
 def parse_time(time_str):
     """convert time string (e.g. '9:00') to datetime.time object"""
     return datetime.strptime(time_str, '%H:%M').time()
 
 
-def get_date_for_week(week_num, academic_year_start):
-    """Calculate the date for a given week number
-
-    Args:
-        week_num: Week number
-        academic_year_start: First Monday of Week 1
-
-    Returns:
-        datetime: Date of the Monday of the specified week
-    """
-    target_date = academic_year_start + timedelta(weeks=week_num-1)
-    return target_date
-
-
-def parse_table_row(cells, day_offset, cal, academic_year_start, class_filter=None):
-    """Parse a single row from the timetable and create events
-
-    Args:
-        cells: List of table cells containing class information
-        day_offset: Integer offset from Monday (0 = Monday, 1 = Tuesday, etc.)
-        cal: Calendar object to add events to
-        academic_year_start: First Monday of Week 1
-        class_filter: Optional function to filter classes
-    """
-    # Extract information from cells
-    module_code = cells[0].text.strip()
-    module_name = cells[1].text.strip()
-    event_type = cells[2].text.strip()
-    size = cells[3].text.strip()
-    start_time = cells[5].text.strip()
-    end_time = cells[6].text.strip()
-    location = cells[8].text.strip()
-    staff = cells[11].text.strip()
-    weeks_text = cells[12].text.strip()
-
-    # Check if the class should be included
-    if class_filter and not class_filter(module_code, module_name, event_type):
-        return
-
-    # Parse weeks (e.g., "23-30, 32-35")
-    week_ranges = weeks_text.split(',')
-
-    # Map day offsets to iCalendar day abbreviations
-    day_abbr = ['MO', 'TU', 'WE', 'TH', 'FR']
-
-    for week_range in week_ranges:
+def parse_weeks(weeks_text):
+    """convert a weeks string (e.g. '23-30, 32-35') to a sorted tuple of week numbers"""
+    weeks = set()
+    for week_range in weeks_text.split(','):
         start, end = 0, 0
         if '-' in week_range:
             start, end = map(int, week_range.strip().split('-'))
         else:
             start = end = int(week_range.strip())
+        weeks.update(range(start, end + 1))
+    return tuple(sorted(weeks))
 
-        # Create a single event with a repeating rule for the current range of weeks
-        event = Event()
-        event.add('summary', f"{module_name} ({event_type})")
-
-        # Calculate event date and time for the first occurrence in this range
-        base_date = get_date_for_week(start, academic_year_start)
-        event_date = base_date + timedelta(days=day_offset)
 
-        # Set start and end times
-        start_dt = datetime.combine(event_date, parse_time(start_time))
-        end_dt = datetime.combine(event_date, parse_time(end_time))
+def parse_table_row(cells, day_offset):
+    """Parse a single row from the timetable
 
-        # Specify timezone
-        malaysia_tz = pytz.timezone('Asia/Kuala_Lumpur')
-        start_dt = malaysia_tz.localize(start_dt)
-        end_dt = malaysia_tz.localize(end_dt)
-
-        event.add('dtstart', start_dt)
-        event.add('dtend', end_dt)
-        event.add('location', location)
-        event.add('description', f"Module: {
-                  module_code}\nStaff: {staff}\nSize: {size}")
+    Args:
+        cells: List of table cells containing class information
+        day_offset: Integer offset from Monday (0 = Monday, 1 = Tuesday, etc.)
 
-        event.add('rrule', {
-            'freq': 'WEEKLY',
-            'interval': 1,
-            'count': end - start + 1,
-            'byday': day_abbr[day_offset]
-        })
+    Returns:
+        ClassRow describing the class
+    """
+    # Extract information from cells
+    module_code = cells[0].get_text().strip()
+    module_name = cells[1].get_text().strip()
+    event_type = cells[2].get_text().strip()
+    size = cells[3].get_text().strip()
+    start_time = cells[5].get_text().strip()
+    end_time = cells[6].get_text().strip()
+    location = cells[8].get_text().strip()
+    staff = cells[11].get_text().strip()
+    weeks_text = cells[12].get_text().strip()
 
-        cal.add_component(event)
+    return ClassRow(module_code, module_name, event_type, size, day_offset,
+                    start_time, end_time, location, staff, weeks_text)
 
 
-def parse_day_table(table, day_offset, cal, academic_year_start, class_filter=None):
-    """Parse a single day's table and add events to the calendar
+def parse_day_table(table, day_offset):
+    """Parse a single day's table
 
     Args:
         table: BeautifulSoup table element containing the day's schedule
         day_offset: Integer offset from Monday (0 = Monday, 1 = Tuesday, etc.)
-        cal: Calendar object to add events to
-        academic_year_start: First Monday of Week 1 (default)
-        class_filter: Optional function to filter classes
+
+    Returns:
+        List of ClassRow, one per row of the table
     """
+    class_rows = []
     # Process each row in the table
-    rows = table.find_all('tr')[1:]  # Skip header row
+    rows = iter(table.find_all('tr'))
+    next(rows, None)  # Skip header row
     for row in rows:
         cells = row.find_all(['td', 'th'])
         if len(cells) != 13:
             raise ValueError(
                 "Invalid timetable format: Missing columns in row")
 
-        parse_table_row(cells, day_offset, cal,
-                        academic_year_start, class_filter)
+        class_rows.append(parse_table_row(cells, day_offset))
+    return class_rows
 
 
-def create_ics(url, academic_year_start, class_filter=None):
-    """Create an ICS file from the timetable
+def parse_all(url):
+    """Fetch and parse the timetable in a single pass
 
     Args:
         url: The timetable URL
-        academic_year_start: First Monday of Week 1
-        class_filter: Optional function to filter classes
-    """
-    response = requests.get(url, timeout=REQUEST_TIMEOUT)
-    soup = BeautifulSoup(response.text, 'html.parser')
-
-    # Create calendar
-    cal = Calendar()
-    cal.add('prodid', '-//UNMC Timetable//EN')
-    cal.add('version', '2.0')
 
-    # Map day names to numbers (0 = Monday)
-    day_map = {'Monday': 0, 'Tuesday': 1,
-               'Wednesday': 2, 'Thursday': 3, 'Friday': 4}
+    Returns:
+        Tuple of the set of available classes in the format
+        "Module Code - Module Name" and a tuple of ClassRow for every row
+    """
+    response = _SESSION.get(url, timeout=REQUEST_TIMEOUT)
+    # Don't parse (and cache) an error or maintenance page as an empty timetable
+    response.raise_for_status()
+    # Only day headers and their tables are needed, skip building the rest
+    soup = BeautifulSoup(response.content, 'lxml',
+                         parse_only=SoupStrainer(['p', 'table']))
 
     # Find all day headers and their corresponding tables
-    day_headers = soup.find_all(
-        'p', string=lambda s: s and s.strip() in day_map)
+    day_headers = soup.find_all('p', string=_DAY_RE)
 
+    day_tables = []
     for day_header in day_headers:
-        day_name = day_header.text.strip()
-        day_offset = day_map[day_name]
+        day_name = day_header.get_text(strip=True)
+        day_offset = DAY_MAP[day_name]
 
         # Get the table that follows this day header
         table = day_header.find_next('table')
         if not table:
             continue
 
-        parse_day_table(table, day_offset, cal,
-                        academic_year_start, class_filter)
+        day_tables.append((table, day_offset))
+
+    class_rows = []
+    for table, day_offset in day_tables:
+        class_rows.extend(parse_day_table(table, day_offset))
+
+    class_options = frozenset(f"{row.module_code} - {row.module_name}"
+                              for row in class_rows)
+    return class_options, tuple(class_rows)
+
+
+def write_event(buf, row, academic_year_start):
+    """Append the VEVENT for a timetable row
+
+    Args:
+        buf: bytearray to append the VEVENT block to
+        row: ClassRow to create the event for
+        academic_year_start: First Monday of Week 1
+    """
+    weeks = parse_weeks(row.weeks_text)
+    first, last = weeks[0], weeks[-1]
+    start_t = parse_time(row.start_time)
+    end_t = parse_time(row.end_time)
+    summary = f"{row.module_name} ({row.event_type})"
+    description = f"Module: {row.module_code}\nStaff: {row.staff}\nSize: {row.size}"
+
+    # Times are seconds since the Unix epoch with Malaysia wall-clock time
+    # treated as UTC, so gmtime() formats them as local times for TZID
+    day_base = (academic_year_start.toordinal() - _EPOCH_ORDINAL
+                + row.day_offset) * DAY_SECONDS
+    start_secs = start_t.hour * 3600 + start_t.minute * 60
+    end_secs = end_t.hour * 3600 + end_t.minute * 60
+
+    def stamp(week, secs):
+        return time.strftime(
+            '%Y%m%dT%H%M%S', time.gmtime(day_base + (week - 1) * WEEK_SECONDS + secs))
+
+    # One event covers every week: a weekly rule with the gaps excluded, or
+    # the remaining dates listed explicitly, whichever is shorter
+    recurrence = [
+        f"RRULE:FREQ=WEEKLY;COUNT={last - first + 1};BYDAY={DAY_ABBR[row.day_offset]}"]
+    gaps = set(range(first, last + 1)).difference(weeks)
+    if gaps:
+        exdates = ','.join(stamp(week, start_secs) for week in sorted(gaps))
+        recurrence.append(f"EXDATE;TZID={TZID}:{exdates}")
+        rdates = ','.join(stamp(week, start_secs) for week in weeks[1:])
+        rdate = f"RDATE;TZID={TZID}:{rdates}"
+        if len(rdate) < sum(len(line) for line in recurrence):
+            recurrence = [rdate]
+    recurrence_lines = ''.join(f"{fold_line(line)}\r\n" for line in recurrence)
+
+    buf += (
+        "BEGIN:VEVENT\r\n"
+        f"{fold_line(f'SUMMARY:{escape_text(summary)}')}\r\n"
+        f"{fold_line(f'LOCATION:{escape_text(row.location)}')}\r\n"
+        f"{fold_line(f'DESCRIPTION:{escape_text(description)}')}\r\n"
+        f"DTSTART;TZID={TZID}:{stamp(first, start_secs)}\r\n"
+        f"DTEND;TZID={TZID}:{stamp(first, end_secs)}\r\n"
+        f"{recurrence_lines}"
+        "END:VEVENT\r\n"
+    ).encode('utf-8')
+
+
+def build_ics(class_rows, academic_year_start, class_filter=None):
+    """Create an ICS file from already parsed timetable rows
+
+    Args:
+        class_rows: ClassRow tuples as returned by parse_all
+        academic_year_start: First Monday of Week 1
+        class_filter: Optional function to filter classes
+    """
+    # The same class appears on many rows, so only decide once per class
+    if class_filter:
+        class_filter = functools.lru_cache(maxsize=256)(class_filter)
+
+    # Create calendar
+    buf = bytearray(
+        b"BEGIN:VCALENDAR\r\n"
+        b"PRODID:-//UNMC Timetable//EN\r\n"
+        b"VERSION:2.0\r\n"
+    )
+    buf += VTIMEZONE.encode('ascii')
+
+    for row in class_rows:
+        # Check if the class should be included
+        if class_filter and not class_filter(
+                row.module_code, row.module_name, row.event_type):
+            continue
+        write_event(buf, row, academic_year_start)
+
+    buf += b"END:VCALENDAR\r\n"
+    return bytes(buf)
+
+
+def create_ics(url, academic_year_start, class_filter=None):
+    """Create an ICS file from the timetable
 
-    return cal.to_ical()
+    Args:
+        url: The timetable URL
+        academic_year_start: First Monday of Week 1
+        class_filter: Optional function to filter classes
+    """
+    _, class_rows = parse_all(url)
+    return build_ics(class_rows, academic_year_start, class_filter)
 
 
 def get_available_classes(url):
@@ -169,19 +304,5 @@ def get_available_classes(url):
     Returns:
         List of available classes in the format "Module Code - Module Name"
     """
-    response = requests.get(url, timeout=REQUEST_TIMEOUT)
-    soup = BeautifulSoup(response.text, 'html.parser')
-
-    class_options = set()
-    tables = soup.find_all('table')
-    for table in tables:
-        rows = table.find_all('tr')[1:]  # Skip header row
-        for row in rows:
-            cells = row.find_all(['td', 'th'])
-            if len(cells) < 12:
-                continue
-            module_code = cells[0].text.strip()
-            module_name = cells[1].text.strip()
-            class_options.add(f"{module_code} - {module_name}")
-
+    class_options, _ = parse_all(url)
     return list(class_options)